@@ -12,13 +12,34 @@ load_dotenv()
 
 # Base directories
 BASE_DIR = Path(__file__).resolve().parent.parent
-TEMP_DIR = BASE_DIR / "temp"
-TEMP_DIR.mkdir(exist_ok=True)
+# Point at tmpfs (e.g. /dev/shm/transcript) for RAM-speed temp I/O.
+# Must be a dedicated directory: old files in it are swept (never use /tmp itself)
+TEMP_DIR = Path(os.getenv("TEMP_DIR") or BASE_DIR / "temp")
+TEMP_DIR.mkdir(parents=True, exist_ok=True)
+
+# Temp files older than this are swept (covers crashes / skipped cleanups)
+TEMP_FILE_MAX_AGE = int(os.getenv("TEMP_FILE_MAX_AGE", "3600"))  # seconds
+TEMP_SWEEP_INTERVAL = int(os.getenv("TEMP_SWEEP_INTERVAL", "600"))  # seconds
+
+# Max concurrent yt-dlp jobs (downloads + format lookups)
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+
+# CORS: comma-separated list of allowed origins ("*" = any origin)
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "*").split(",")
+    if origin.strip()
+]
 
 # Cloudflare AI Configuration
 CLOUDFLARE_ACCOUNT_ID = os.getenv("CLOUDFLARE_ACCOUNT_ID", "")
 CLOUDFLARE_API_TOKEN = os.getenv("CLOUDFLARE_API_TOKEN", "")
 WHISPER_MODEL = os.getenv("WHISPER_MODEL", "@cf/openai/whisper")
+# Optional smaller/faster model for short clips (e.g. @cf/openai/whisper-tiny-en)
+SHORT_AUDIO_MODEL = os.getenv("SHORT_AUDIO_MODEL", "")
+SHORT_AUDIO_MAX_DURATION = int(os.getenv("SHORT_AUDIO_MAX_DURATION", "120"))  # seconds
+# Open the connection to Cloudflare at startup instead of on the first request
+CLOUDFLARE_WARMUP = os.getenv("CLOUDFLARE_WARMUP", "1") == "1"
 
 # API URL for Cloudflare Workers AI
 CLOUDFLARE_AI_URL = f"https://api.cloudflare.com/client/v4/accounts/{CLOUDFLARE_ACCOUNT_ID}/ai/run/{WHISPER_MODEL}"
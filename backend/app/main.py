@@ -8,31 +8,140 @@ Universal Transcription API v3.0
 
 from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import BinaryIO, Optional, List
 import time
-import uuid
+import itertools
+import json
 import os
+import shutil
+import sys
 import asyncio
 from pathlib import Path
-
-from app.config import validate_config, CLOUDFLARE_ACCOUNT_ID, TEMP_DIR
+from contextlib import asynccontextmanager
+import httpx
+
+from app.config import (
+    validate_config,
+    CLOUDFLARE_ACCOUNT_ID,
+    CLOUDFLARE_WARMUP,
+    CORS_ORIGINS,
+    TEMP_DIR,
+    TEMP_FILE_MAX_AGE,
+    TEMP_SWEEP_INTERVAL,
+)
 from app.services.audio_downloader import (
     download_audio,
     download_video,
     cleanup_audio_file,
+    sweep_temp_dir,
     AudioDownloadError,
     get_supported_platforms,
     get_available_formats,
 )
 from app.services.transcription import (
     transcribe_audio,
+    iter_transcription_chunks,
+    TranscriptBuilder,
+    create_client,
+    warm_up_connection,
     TranscriptionError,
 )
 
-# Store active jobs for progress tracking and cancellation
-active_jobs = {}
+# Running /transcribe jobs by client-chosen job_id, for cancellation. Server
+# IDs are sequential (guessable) and never registered, so nobody can cancel
+# another user's job by counting. The request removes its entry when it
+# finishes, whatever the outcome. Per worker process.
+active_jobs: dict[str, asyncio.Task] = {}
+
+# Job IDs: process tag (start time + pid) followed by a per-process counter
+_JOB_ID_PREFIX = f"{int(time.time()):x}{os.getpid():x}"
+_job_counter = itertools.count()
+
+
+def new_job_id() -> str:
+    """Return a job ID unique across workers without touching os.urandom."""
+    return f"{_JOB_ID_PREFIX}{next(_job_counter):06x}"
+
+
+class _FilenameTable(dict):
+    """
+    str.translate() table keeping alphanumerics and ' .-_'.
+    Filled lazily per code point, so repeated characters stay on the C path.
+    """
+    def __missing__(self, codepoint: int) -> Optional[int]:
+        char = chr(codepoint)
+        value = codepoint if char.isalnum() or char in ' .-_' else None
+        self[codepoint] = value
+        return value
+
+
+_FILENAME_TABLE = _FilenameTable()
+
+# Upload limits
+MAX_UPLOAD_SIZE = 25 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+ALLOWED_UPLOAD_EXTENSIONS = frozenset({'.mp3', '.mp4', '.wav', '.m4a', '.webm', '.ogg'})
+
+
+def _save_upload(src: BinaryIO, dest: Path) -> None:
+    """
+    Copy an upload's spooled body (Starlette SpooledTemporaryFile) to dest,
+    enforcing the size limit before anything is written.
+    Runs entirely in one worker thread: open, copy and close cost a single
+    event-loop hop.
+    """
+    size = src.seek(0, os.SEEK_END)
+    if size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail="File quá lớn. Tối đa 25MB.")
+    src.seek(0)
+    
+    with open(dest, 'wb') as out:
+        # Spool already on disk (>1MB): copy in-kernel, no pass through Python buffers
+        if sys.platform == 'linux' and getattr(src, '_rolled', False):
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(out.fileno(), src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        else:
+            shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+
+
+async def _sweep_temp_files():
+    """Periodically delete stale temp files that per-request cleanup missed."""
+    while True:
+        try:
+            removed = await asyncio.to_thread(sweep_temp_dir, TEMP_FILE_MAX_AGE)
+            if removed:
+                print(f"[CLEANUP] Removed {removed} stale temp file(s)")
+        except Exception as e:
+            print(f"[ERROR] Temp sweep failed: {e}")
+        await asyncio.sleep(TEMP_SWEEP_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Config can't change after boot: fail fast here instead of on every request
+    validate_config()
+    
+    # One pooled HTTP/2 client for all Cloudflare calls: TCP + TLS handshakes
+    # are paid once and concurrent chunk uploads share a connection
+    app.state.http_client = create_client(
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+    background = [asyncio.create_task(_sweep_temp_files())]
+    if CLOUDFLARE_WARMUP:
+        # Runs alongside startup; doesn't delay the server accepting requests
+        background.append(asyncio.create_task(warm_up_connection(app.state.http_client)))
+    yield
+    for task in background:
+        task.cancel()
+    await app.state.http_client.aclose()
+
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -52,22 +161,45 @@ YouTube, Facebook, Instagram, TikTok, Twitter/X, Vimeo, SoundCloud, và 1000+ ng
     version="3.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=CORS_ORIGINS,
+    # Browsers reject credentialed requests to a wildcard origin anyway
+    allow_credentials="*" not in CORS_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # Let browsers cache preflight responses for a day
 )
 
 
+class MediaAwareGZipMiddleware(GZipMiddleware):
+    """
+    GZip that leaves some paths alone:
+    - /download: MP3/MP4 don't compress, and gzip breaks Range/Content-Length
+    - /transcribe/stream: gzip buffers small NDJSON lines instead of sending them
+    """
+    skip_paths = frozenset({"/download", "/transcribe/stream"})
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+# Compress JSON responses (the `words` list in transcripts compresses very well)
+app.add_middleware(MediaAwareGZipMiddleware, minimum_size=1024, compresslevel=4)
+
+
 # Request/Response models
 class TranscribeRequest(BaseModel):
     url: str
     language: Optional[str] = None
+    job_id: Optional[str] = None  # Client-chosen ID, lets it cancel the job mid-flight
     
     class Config:
         json_schema_extra = {
@@ -130,82 +262,114 @@ class JobStatus(BaseModel):
     result: Optional[dict] = None
 
 
+# Static responses (inputs never change while the process runs)
+SUPPORTED_PLATFORMS = get_supported_platforms()
+
+HEALTH_RESPONSE = HealthResponse(
+    status="healthy",
+    cloudflare_configured=bool(CLOUDFLARE_ACCOUNT_ID),
+    version="3.0.0",
+    supported_platforms=SUPPORTED_PLATFORMS,
+)
+
+PLATFORMS_RESPONSE = {
+    "platforms": SUPPORTED_PLATFORMS,
+    "note": "yt-dlp hỗ trợ 1000+ nguồn. Một số Facebook Reels có thể không hoạt động do format mới."
+}
+
+INFO_RESPONSE = {
+    "version": "3.0.0",
+    "limits": {
+        "max_file_size_mb": MAX_UPLOAD_SIZE // (1024 * 1024),
+        "max_video_duration_minutes": 30,
+        "supported_audio_formats": ["mp3", "wav", "m4a", "webm", "ogg"],
+        "supported_video_formats": ["mp4", "webm"],
+    },
+    "notes": {
+        "language": "Tham số language là GỢI Ý cho Whisper, không phải dịch tự động",
+        "music": "Whisper chỉ nhận dạng lời nói, không nhận dạng lyrics bài hát",
+        "facebook_reels": "Một số Facebook Reels có format mới chưa được hỗ trợ"
+    }
+}
+
+
 # API Endpoints
 @app.get("/", response_model=HealthResponse)
 async def health_check():
     """Health check với danh sách platforms."""
-    return HealthResponse(
-        status="healthy",
-        cloudflare_configured=bool(CLOUDFLARE_ACCOUNT_ID),
-        version="3.0.0",
-        supported_platforms=get_supported_platforms()
-    )
+    return HEALTH_RESPONSE
 
 
 @app.get("/health", response_model=HealthResponse)
 async def health():
-    return await health_check()
+    return HEALTH_RESPONSE
+
+
+@app.head("/health", status_code=204)
+async def health_probe():
+    """Liveness probe rẻ (không có body), dùng cho monitoring/benchmark."""
+    return Response(status_code=204)
 
 
 @app.get("/platforms")
 async def list_platforms():
     """Danh sách các nền tảng được hỗ trợ."""
-    return {
-        "platforms": get_supported_platforms(),
-        "note": "yt-dlp hỗ trợ 1000+ nguồn. Một số Facebook Reels có thể không hoạt động do format mới."
-    }
+    return PLATFORMS_RESPONSE
 
 
-@app.post("/transcribe", response_model=TranscribeResponse)
-async def transcribe(
+def _download_http_error(url: str, error: AudioDownloadError) -> HTTPException:
+    """Map a download failure to a 400, with a hint for unsupported Facebook Reels."""
+    error_msg = str(error)
+    if 'facebook' in url.lower() and 'Cannot parse' in error_msg:
+        return HTTPException(
+            status_code=400,
+            detail="Facebook Reels format không được hỗ trợ. Thử dùng link video thường (facebook.com/watch/...)"
+        )
+    return HTTPException(status_code=400, detail=error_msg)
+
+
+def _ndjson(obj: dict) -> str:
+    """Serialize one NDJSON line."""
+    return json.dumps(obj, ensure_ascii=False) + "\n"
+
+
+async def _transcribe_url(
     request: TranscribeRequest,
+    job_id: str,
     background_tasks: BackgroundTasks
-):
-    """
-    Transcribe audio từ URL.
-    
-    **Lưu ý về ngôn ngữ:**
-    - Tham số `language` là GỢI Ý cho Whisper, không phải dịch tự động
-    - Nếu không chọn, Whisper sẽ tự đoán ngôn ngữ
-    - Chọn đúng ngôn ngữ giúp transcription chính xác hơn
-    
-    **Lưu ý về nhạc:**
-    - Whisper chỉ nhận dạng LỜI NÓI, không phải lyrics bài hát
-    - Video có nhạc sẽ hiển thị [Music] hoặc bỏ qua
-    """
+) -> TranscribeResponse:
+    """Download + transcribe body of /transcribe, run as a cancellable task."""
     start_time = time.time()
-    job_id = str(uuid.uuid4())[:8]
     audio_path = None
+    cleanup_scheduled = False
     metadata = {}
     
     try:
-        validate_config()
-        
         # Download audio
         try:
             audio_path, metadata = await download_audio(request.url)
         except AudioDownloadError as e:
-            error_msg = str(e)
-            # Provide helpful error for Facebook Reels
-            if 'facebook' in request.url.lower() and 'Cannot parse' in error_msg:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Facebook Reels format không được hỗ trợ. Thử dùng link video thường (facebook.com/watch/...)"
-                )
-            raise HTTPException(status_code=400, detail=error_msg)
+            raise _download_http_error(request.url, e)
         
         # Transcribe
         try:
-            result = await transcribe_audio(audio_path, language=request.language)
+            result = await transcribe_audio(
+                audio_path,
+                language=request.language,
+                client=app.state.http_client,
+                duration=metadata.get('duration'),
+            )
         except TranscriptionError as e:
             raise HTTPException(status_code=500, detail=str(e))
         
         processing_time = time.time() - start_time
         
-        if audio_path:
+        if audio_path is not None:
             background_tasks.add_task(cleanup_audio_file, audio_path)
+            cleanup_scheduled = True
         
-        return TranscribeResponse(
+        # Fields come from our own code: skip re-validating every entry of `words`
+        return TranscribeResponse.model_construct(
             success=True,
             text=result['text'],
             text_raw=result.get('text_raw'),
@@ -223,20 +387,150 @@ async def transcribe(
         
     except HTTPException:
         raise
-    except ValueError as e:
-        raise HTTPException(status_code=500, detail=f"Lỗi cấu hình: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi không mong đợi: {str(e)}")
     finally:
-        if audio_path and audio_path.exists():
-            background_tasks.add_task(cleanup_audio_file, audio_path)
+        # BackgroundTasks are dropped on error responses, so clean up here
+        if audio_path is not None and not cleanup_scheduled:
+            await cleanup_audio_file(audio_path)
+
+
+@app.post("/transcribe", response_model=TranscribeResponse)
+async def transcribe(
+    request: TranscribeRequest,
+    background_tasks: BackgroundTasks
+):
+    """
+    Transcribe audio từ URL.
+    
+    **Lưu ý về ngôn ngữ:**
+    - Tham số `language` là GỢI Ý cho Whisper, không phải dịch tự động
+    - Nếu không chọn, Whisper sẽ tự đoán ngôn ngữ
+    - Chọn đúng ngôn ngữ giúp transcription chính xác hơn
+    
+    **Lưu ý về nhạc:**
+    - Whisper chỉ nhận dạng LỜI NÓI, không phải lyrics bài hát
+    - Video có nhạc sẽ hiển thị [Music] hoặc bỏ qua
+    
+    **Hủy job:**
+    - Gửi kèm `job_id` tự chọn, rồi gọi `POST /jobs/{job_id}/cancel` để hủy
+    - Dùng ID ngẫu nhiên, khó đoán (ví dụ UUID): ai biết ID đều hủy được job
+    - Job không gửi `job_id` thì không hủy được
+    """
+    if request.job_id is not None:
+        existing = active_jobs.get(request.job_id)
+        if existing is not None and not existing.done():
+            raise HTTPException(status_code=409, detail=f"Job {request.job_id} đang chạy")
+    
+    job_id = request.job_id or new_job_id()
+    task = asyncio.create_task(_transcribe_url(request, job_id, background_tasks))
+    if request.job_id is not None:
+        active_jobs[job_id] = task
+    try:
+        await asyncio.wait({task})
+    except asyncio.CancelledError:
+        # Request itself was cancelled (client gone / shutdown): stop the job too
+        task.cancel()
+        raise
+    finally:
+        # A retry with the same ID may already have replaced this entry
+        if active_jobs.get(job_id) is task:
+            del active_jobs[job_id]
+    
+    if task.cancelled():
+        raise HTTPException(status_code=409, detail=f"Job {job_id} đã bị hủy")
+    return task.result()
+
+
+@app.post("/transcribe/stream")
+async def transcribe_stream(
+    request: TranscribeRequest,
+    background_tasks: BackgroundTasks
+):
+    """
+    Transcribe audio từ URL, trả kết quả dần dần dạng NDJSON (mỗi dòng một JSON).
+    
+    Client nhận được văn bản của từng đoạn audio ngay khi đoạn đó xong,
+    không phải chờ toàn bộ file. Thứ tự các dòng:
+    - `{"type": "metadata", ...}` sau khi tải audio xong
+    - `{"type": "chunk", "index", "total", "text", "words"}` cho từng đoạn
+    - `{"type": "done", "text", "text_raw", "word_count", "language", "vtt", "processing_time"}`
+    - `{"type": "error", "detail"}` nếu transcription lỗi giữa chừng
+    
+    Không hỗ trợ `job_id`: muốn hủy thì đóng kết nối.
+    """
+    start_time = time.time()
+    
+    try:
+        audio_path, metadata = await download_audio(request.url)
+    except AudioDownloadError as e:
+        raise _download_http_error(request.url, e)
+    background_tasks.add_task(cleanup_audio_file, audio_path)
+    
+    async def ndjson_lines():
+        yield _ndjson({
+            "type": "metadata",
+            "platform": metadata.get('platform', 'unknown'),
+            "title": metadata.get('title'),
+            "duration": metadata.get('duration'),
+        })
+        
+        transcript = TranscriptBuilder(request.language)
+        try:
+            async for part in iter_transcription_chunks(
+                audio_path, request.language, app.state.http_client,
+                metadata.get('duration'),
+            ):
+                transcript.add_chunk(part)
+                yield _ndjson({
+                    "type": "chunk",
+                    "index": part['index'],
+                    "total": part['total'],
+                    "text": part['text'],
+                    "words": part['words'],
+                })
+        except TranscriptionError as e:
+            yield _ndjson({"type": "error", "detail": str(e)})
+            return
+        except Exception as e:
+            yield _ndjson({"type": "error", "detail": f"Lỗi không mong đợi: {str(e)}"})
+            return
+        
+        result = transcript.build()
+        yield _ndjson({
+            "type": "done",
+            "text": result['text'],
+            "text_raw": result['text_raw'],
+            "word_count": result['word_count'],
+            "language": result['language'],
+            "vtt": result['vtt'],
+            "processing_time": round(time.time() - start_time, 2),
+        })
+    
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=JobStatus)
+async def cancel_job(job_id: str):
+    """Hủy một job /transcribe đang chạy (chỉ job có `job_id` do client gửi)."""
+    task = active_jobs.get(job_id)
+    if task is None or task.done():
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy job {job_id} đang chạy")
+    
+    task.cancel()
+    return JobStatus(
+        job_id=job_id,
+        status="cancelled",
+        progress=0,
+        message="Job đã bị hủy",
+    )
 
 
 @app.post("/transcribe/upload", response_model=TranscribeResponse)
 async def transcribe_upload(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     language: Optional[str] = Form(None),
-    background_tasks: BackgroundTasks = None
 ):
     """
     Transcribe từ file upload (MP3, MP4, WAV, M4A, WebM).
@@ -247,39 +541,36 @@ async def transcribe_upload(
     - Tối đa 25MB
     """
     start_time = time.time()
-    job_id = str(uuid.uuid4())[:8]
+    job_id = new_job_id()
     
     # Validate file type
-    allowed_types = ['audio/mpeg', 'audio/mp3', 'audio/wav', 'audio/m4a', 
-                     'audio/webm', 'video/mp4', 'video/webm', 'audio/mp4']
-    allowed_extensions = ['.mp3', '.mp4', '.wav', '.m4a', '.webm', '.ogg']
-    
     file_ext = os.path.splitext(file.filename)[1].lower()
-    if file_ext not in allowed_extensions:
+    if file_ext not in ALLOWED_UPLOAD_EXTENSIONS:
         raise HTTPException(
             status_code=400, 
-            detail=f"File type không hỗ trợ. Chấp nhận: {', '.join(allowed_extensions)}"
+            detail=f"File type không hỗ trợ. Chấp nhận: {', '.join(sorted(ALLOWED_UPLOAD_EXTENSIONS))}"
         )
     
-    # Save uploaded file
+    # Stream uploaded file to disk (64 KiB chunks, 25MB limit)
     temp_path = TEMP_DIR / f"{job_id}_{file.filename}"
+    cleanup_scheduled = False
     try:
-        content = await file.read()
-        
-        # Check file size (25MB limit)
-        if len(content) > 25 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File quá lớn. Tối đa 25MB.")
-        
-        with open(temp_path, 'wb') as f:
-            f.write(content)
+        await asyncio.to_thread(_save_upload, file.file, temp_path)
         
         # Transcribe
-        validate_config()
-        result = await transcribe_audio(temp_path, language=language)
+        result = await transcribe_audio(
+            temp_path,
+            language=language,
+            client=app.state.http_client,
+        )
         
         processing_time = time.time() - start_time
         
-        return TranscribeResponse(
+        background_tasks.add_task(cleanup_audio_file, temp_path)
+        cleanup_scheduled = True
+        
+        # Fields come from our own code: skip re-validating every entry of `words`
+        return TranscribeResponse.model_construct(
             success=True,
             text=result['text'],
             text_raw=result.get('text_raw'),
@@ -301,8 +592,9 @@ async def transcribe_upload(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
     finally:
-        if temp_path.exists():
-            os.remove(temp_path)
+        # BackgroundTasks are dropped on error responses, so clean up here
+        if not cleanup_scheduled:
+            await cleanup_audio_file(temp_path)
 
 
 @app.post("/formats", response_model=FormatsResponse)
@@ -333,12 +625,17 @@ async def download_media(request: DownloadRequest, background_tasks: BackgroundT
         
         filename = f"{metadata.get('title', 'video')[:50]}.{request.format}"
         # Clean filename
-        filename = "".join(c for c in filename if c.isalnum() or c in ' .-_').strip()
+        filename = filename.translate(_FILENAME_TABLE).strip()
+        
+        # Stat off the event loop so the response doesn't have to
+        stat_result = await asyncio.to_thread(os.stat, file_path)
+        background_tasks.add_task(cleanup_audio_file, file_path)
         
         # Return file
         return FileResponse(
             path=str(file_path),
             filename=filename,
+            stat_result=stat_result,
             media_type='audio/mpeg' if request.format == 'mp3' else 'video/mp4',
             background=background_tasks
         )
@@ -352,23 +649,20 @@ async def download_media(request: DownloadRequest, background_tasks: BackgroundT
 @app.get("/info")
 async def get_info():
     """Thông tin về API và giới hạn."""
-    return {
-        "version": "3.0.0",
-        "limits": {
-            "max_file_size_mb": 25,
-            "max_video_duration_minutes": 30,
-            "supported_audio_formats": ["mp3", "wav", "m4a", "webm", "ogg"],
-            "supported_video_formats": ["mp4", "webm"],
-        },
-        "notes": {
-            "language": "Tham số language là GỢI Ý cho Whisper, không phải dịch tự động",
-            "music": "Whisper chỉ nhận dạng lời nói, không nhận dạng lyrics bài hát",
-            "facebook_reels": "Một số Facebook Reels có format mới chưa được hỗ trợ"
-        }
-    }
+    return INFO_RESPONSE
 
 
 # Run with: uvicorn app.main:app --reload
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        # uvloop has no Windows build
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        # Job registry (active_jobs) is per process: with more than one worker a
+        # cancel usually lands on a worker that doesn't know the job (404)
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )
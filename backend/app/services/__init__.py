@@ -2,19 +2,30 @@ from .audio_downloader import (
     download_audio, 
     download_video,
     cleanup_audio_file, 
+    sweep_temp_dir,
     AudioDownloadError,
     get_supported_platforms,
     get_available_formats,
 )
-from .transcription import transcribe_audio, TranscriptionError
+from .transcription import (
+    transcribe_audio,
+    iter_transcription_chunks,
+    create_client,
+    warm_up_connection,
+    TranscriptionError,
+)
 
 __all__ = [
     'download_audio',
     'download_video',
     'cleanup_audio_file', 
+    'sweep_temp_dir',
     'AudioDownloadError',
     'get_supported_platforms',
     'get_available_formats',
     'transcribe_audio',
+    'iter_transcription_chunks',
+    'create_client',
+    'warm_up_connection',
     'TranscriptionError',
 ]
@@ -14,14 +14,37 @@ Full list: https://github.com/yt-dlp/yt-dlp/blob/master/supportedsites.md
 """
 
 import os
+import time
 import uuid
 import asyncio
+import heapq
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, Dict, Any
+import aiofiles.os
 import yt_dlp
 
-from app.config import TEMP_DIR
+from app.config import TEMP_DIR, DOWNLOAD_WORKERS
+
+
+# Desktop browser User-Agent for platforms that block yt-dlp's default one
+_DESKTOP_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+_DESKTOP_HEADERS = {'User-Agent': _DESKTOP_UA}
+_UA_PLATFORMS = frozenset({'instagram', 'facebook', 'tiktok', 'twitter'})
+
+
+# Dedicated threads for blocking yt-dlp calls, so long downloads don't take
+# over the loop's default executor (used by asyncio.to_thread elsewhere)
+_download_executor = ThreadPoolExecutor(
+    max_workers=DOWNLOAD_WORKERS,
+    thread_name_prefix='yt-dlp',
+)
+
+# Per-thread YoutubeDL instances reused for metadata lookups
+_info_ydl_local = threading.local()
 
 
 class AudioDownloadError(Exception):
@@ -29,9 +52,11 @@ class AudioDownloadError(Exception):
     pass
 
 
+@lru_cache(maxsize=1)
 def _get_ffmpeg_location() -> Optional[str]:
     """
     Find FFmpeg location on the system.
+    The result is cached: the probing only runs once per process.
     
     Returns:
         Path to ffmpeg directory or None if not found
@@ -62,19 +87,51 @@ def _get_ffmpeg_location() -> Optional[str]:
     
     # Try to find in WinGet packages folder
     winget_packages = os.path.expandvars(r'%LOCALAPPDATA%\Microsoft\WinGet\Packages')
-    if os.path.exists(winget_packages):
-        for folder in os.listdir(winget_packages):
-            if 'ffmpeg' in folder.lower():
-                bin_path = os.path.join(winget_packages, folder, 'ffmpeg-*-full_build', 'bin')
-                # Use glob to find the actual path
-                import glob
-                matches = glob.glob(os.path.join(winget_packages, folder, '*', 'bin', 'ffmpeg.exe'))
-                if matches:
-                    return os.path.dirname(matches[0])
+    if os.path.isdir(winget_packages):
+        with os.scandir(winget_packages) as entries:
+            for entry in entries:
+                if 'ffmpeg' in entry.name.lower() and entry.is_dir():
+                    # e.g. <package>/ffmpeg-7.0-full_build/bin/ffmpeg.exe - stop at the first match
+                    match = next(Path(entry.path).glob('*/bin/ffmpeg.exe'), None)
+                    if match:
+                        return str(match.parent)
     
     return None
 
 
+# One alternation with a named group per platform, so a single search
+# finds the platform (the group name) instead of trying each pattern in turn
+_PLATFORM_PATTERN = re.compile(
+    r'(?P<youtube>youtube\.com|youtu\.be)'
+    r'|(?P<facebook>facebook\.com|fb\.watch|fb\.com)'
+    r'|(?P<instagram>instagram\.com)'
+    r'|(?P<tiktok>tiktok\.com)'
+    r'|(?P<twitter>twitter\.com|x\.com)'
+    r'|(?P<vimeo>vimeo\.com)'
+    r'|(?P<soundcloud>soundcloud\.com)'
+    r'|(?P<dailymotion>dailymotion\.com)'
+    r'|(?P<twitch>twitch\.tv)'
+    r'|(?P<reddit>reddit\.com)'
+    r'|(?P<bilibili>bilibili\.com)',
+    re.IGNORECASE,
+)
+
+
+def _downloaded_path(info: Optional[Dict[str, Any]]) -> Optional[Path]:
+    """
+    Final file path reported by yt-dlp (after post-processing, e.g. MP3 conversion).
+    
+    Args:
+        info: Info dict returned by extract_info(download=True)
+    
+    Returns:
+        Path of the downloaded file, or None if yt-dlp did not report one
+    """
+    downloads = (info or {}).get('requested_downloads') or []
+    filepath = downloads[0].get('filepath') if downloads else None
+    return Path(filepath) if filepath else None
+
+
 def detect_platform(url: str) -> str:
     """
     Detect the platform from URL for logging/analytics.
@@ -85,32 +142,16 @@ def detect_platform(url: str) -> str:
     Returns:
         Platform name string
     """
-    url_lower = url.lower()
-    
-    patterns = {
-        'youtube': r'(youtube\.com|youtu\.be)',
-        'facebook': r'(facebook\.com|fb\.watch|fb\.com)',
-        'instagram': r'instagram\.com',
-        'tiktok': r'tiktok\.com',
-        'twitter': r'(twitter\.com|x\.com)',
-        'vimeo': r'vimeo\.com',
-        'soundcloud': r'soundcloud\.com',
-        'dailymotion': r'dailymotion\.com',
-        'twitch': r'twitch\.tv',
-        'reddit': r'reddit\.com',
-        'bilibili': r'bilibili\.com',
-    }
-    
-    for platform, pattern in patterns.items():
-        if re.search(pattern, url_lower):
-            return platform
-    
-    return 'other'
+    match = _PLATFORM_PATTERN.search(url)
+    return match.lastgroup if match else 'other'
 
 
+@lru_cache(maxsize=16)
 def get_platform_options(platform: str) -> Dict[str, Any]:
     """
     Get platform-specific yt-dlp options.
+    Built once per platform; the returned dict is shared, copy it before
+    adding per-download keys.
     
     Args:
         platform: Detected platform name
@@ -140,35 +181,14 @@ def get_platform_options(platform: str) -> Dict[str, Any]:
         # Retry on errors
         'retries': 3,
         'fragment_retries': 3,
+        # Keep the download time as mtime (not the server's Last-Modified),
+        # otherwise sweep_temp_dir sees fresh files as stale
+        'updatetime': False,
     }
     
     # Platform-specific options
-    if platform == 'instagram':
-        base_opts.update({
-            # Instagram may need these
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            }
-        })
-    elif platform == 'facebook':
-        base_opts.update({
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            }
-        })
-    elif platform == 'tiktok':
-        base_opts.update({
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            }
-        })
-    elif platform == 'twitter':
-        base_opts.update({
-            # Twitter/X specific
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            }
-        })
+    if platform in _UA_PLATFORMS:
+        base_opts['http_headers'] = _DESKTOP_HEADERS
     
     return base_opts
 
@@ -206,8 +226,10 @@ async def download_audio(
     platform = detect_platform(url)
     
     # Get platform-specific options
-    ydl_opts = get_platform_options(platform)
-    ydl_opts['outtmpl'] = str(TEMP_DIR / output_filename)
+    ydl_opts = {
+        **get_platform_options(platform),
+        'outtmpl': str(TEMP_DIR / output_filename),
+    }
     
     # Add cookies if provided
     if cookies_file and os.path.exists(cookies_file):
@@ -256,34 +278,23 @@ async def download_audio(
             raise AudioDownloadError(f"Failed to download audio: {str(e)}")
     
     # Run in thread pool to avoid blocking
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, _download)
+    loop = asyncio.get_running_loop()
+    info = await loop.run_in_executor(_download_executor, _download)
     
-    # Check if file exists (yt-dlp adds .mp3 extension)
+    # yt-dlp reports the final file (with the extension it actually used)
+    output_path = _downloaded_path(info) or output_path
     if not output_path.exists():
-        # Try to find the downloaded file
-        possible_paths = list(TEMP_DIR.glob(f"{output_filename}.*"))
-        audio_extensions = ['.mp3', '.m4a', '.webm', '.opus', '.wav', '.aac']
-        
-        for ext in audio_extensions:
-            test_path = TEMP_DIR / f"{output_filename}{ext}"
-            if test_path.exists():
-                output_path = test_path
-                break
-        else:
-            if possible_paths:
-                output_path = possible_paths[0]
-            else:
-                raise AudioDownloadError(
-                    f"Downloaded file not found. Platform: {platform}"
-                )
+        raise AudioDownloadError(
+            f"Downloaded file not found. Platform: {platform}"
+        )
     
     return output_path, metadata
 
 
-def cleanup_audio_file(file_path: Path) -> bool:
+async def cleanup_audio_file(file_path: Path) -> bool:
     """
-    Clean up a downloaded audio file.
+    Clean up a downloaded audio file without blocking the event loop.
+    Safe to call more than once for the same path.
     
     Args:
         file_path: Path to the file to delete.
@@ -292,14 +303,41 @@ def cleanup_audio_file(file_path: Path) -> bool:
         True if file was deleted, False otherwise.
     """
     try:
-        if file_path.exists():
-            os.remove(file_path)
-            return True
+        await aiofiles.os.remove(file_path)
+        return True
+    except FileNotFoundError:
         return False
-    except Exception:
+    except Exception as e:
+        print(f"[ERROR] Cleanup failed for {file_path}: {e}")
         return False
 
 
+def sweep_temp_dir(max_age: float) -> int:
+    """
+    Delete files in TEMP_DIR that were last modified more than max_age seconds ago.
+    
+    Catches files whose cleanup never ran (worker crash, restart, error path).
+    Every file in TEMP_DIR is a candidate, so it must be a dedicated directory.
+    
+    Args:
+        max_age: Age threshold in seconds.
+    
+    Returns:
+        Number of files deleted.
+    """
+    cutoff = time.time() - max_age
+    removed = 0
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+
 def get_supported_platforms() -> list[str]:
     """
     Get list of commonly supported platforms.
@@ -349,7 +387,7 @@ async def download_video(
     platform = detect_platform(url)
     
     # For TikTok/Instagram/Facebook - use simpler format selection
-    if platform in ['tiktok', 'instagram', 'facebook', 'twitter']:
+    if platform in _UA_PLATFORMS:
         # These platforms often have limited formats
         if format_id:
             format_string = format_id
@@ -378,13 +416,13 @@ async def download_video(
         'geo_bypass': True,
         'retries': 3,
         'merge_output_format': 'mp4',
+        # See get_platform_options: mtime must be the download time
+        'updatetime': False,
     }
     
     # Add platform-specific headers
-    if platform in ['instagram', 'facebook', 'tiktok', 'twitter']:
-        ydl_opts['http_headers'] = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
+    if platform in _UA_PLATFORMS:
+        ydl_opts['http_headers'] = _DESKTOP_HEADERS
     
     metadata = {
         'platform': platform,
@@ -405,27 +443,48 @@ async def download_video(
         except Exception as e:
             raise AudioDownloadError(f"Download failed: {str(e)}")
     
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, _download)
+    loop = asyncio.get_running_loop()
+    info = await loop.run_in_executor(_download_executor, _download)
     
     # Find the downloaded file
+    output_path = _downloaded_path(info) or output_path
     if not output_path.exists():
-        possible_paths = list(TEMP_DIR.glob(f"{output_filename}.*"))
-        video_extensions = ['.mp4', '.webm', '.mkv', '.avi', '.mov']
-        for ext in video_extensions:
-            test_path = TEMP_DIR / f"{output_filename}{ext}"
-            if test_path.exists():
-                output_path = test_path
-                break
-        else:
-            if possible_paths:
-                output_path = possible_paths[0]
-            else:
-                raise AudioDownloadError("Downloaded file not found")
+        raise AudioDownloadError("Downloaded file not found")
     
     return output_path, metadata
 
 
+def _get_info_ydl(desktop_ua: bool) -> yt_dlp.YoutubeDL:
+    """
+    Get a YoutubeDL for info-only extraction, reused across calls on this thread.
+    
+    Creating one (options, extractor registry, HTTP handlers) is costly, and the
+    options for metadata lookups never change. Instances are not thread-safe,
+    so each worker thread keeps its own.
+    
+    Args:
+        desktop_ua: Whether to send the desktop browser User-Agent
+    
+    Returns:
+        Reusable YoutubeDL instance (do not close it)
+    """
+    pool = getattr(_info_ydl_local, 'pool', None)
+    if pool is None:
+        pool = _info_ydl_local.pool = {}
+    
+    ydl = pool.get(desktop_ua)
+    if ydl is None:
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+        }
+        if desktop_ua:
+            ydl_opts['http_headers'] = _DESKTOP_HEADERS
+        ydl = pool[desktop_ua] = yt_dlp.YoutubeDL(ydl_opts)
+    return ydl
+
+
 async def get_available_formats(url: str) -> Dict[str, Any]:
     """
     Get available download formats for a URL.
@@ -438,26 +497,15 @@ async def get_available_formats(url: str) -> Dict[str, Any]:
     """
     platform = detect_platform(url)
     
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'skip_download': True,
-    }
-    
-    if platform in ['instagram', 'facebook', 'tiktok', 'twitter']:
-        ydl_opts['http_headers'] = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
-    
     def _get_info():
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                return ydl.extract_info(url, download=False)
+            ydl = _get_info_ydl(platform in _UA_PLATFORMS)
+            return ydl.extract_info(url, download=False)
         except Exception as e:
             raise AudioDownloadError(f"Cannot get video info: {str(e)}")
     
-    loop = asyncio.get_event_loop()
-    info = await loop.run_in_executor(None, _get_info)
+    loop = asyncio.get_running_loop()
+    info = await loop.run_in_executor(_download_executor, _get_info)
     
     if not info:
         raise AudioDownloadError("No video info found")
@@ -468,6 +516,8 @@ async def get_available_formats(url: str) -> Dict[str, Any]:
     
     video_formats = []
     audio_formats = []
+    # First video format seen for each height (what the UI options show)
+    best_by_height: Dict[int, Dict[str, Any]] = {}
     
     for fmt in formats:
         format_id = fmt.get('format_id', '')
@@ -500,15 +550,17 @@ async def get_available_formats(url: str) -> Dict[str, Any]:
             format_info['vcodec'] = vcodec
             format_info['has_audio'] = acodec != 'none' and acodec
             video_formats.append(format_info)
+            if height >= 360:
+                best_by_height.setdefault(height, format_info)
         elif acodec != 'none' and acodec:
             format_info['type'] = 'audio'
             format_info['abr'] = fmt.get('abr', 0)  # Audio bitrate
             format_info['acodec'] = acodec
             audio_formats.append(format_info)
     
-    # Sort by quality
-    video_formats.sort(key=lambda x: x.get('height', 0), reverse=True)
-    audio_formats.sort(key=lambda x: x.get('abr', 0), reverse=True)
+    # Only the best few are returned, so select them instead of sorting everything
+    video_formats = heapq.nlargest(10, video_formats, key=lambda x: x['height'])
+    audio_formats = heapq.nlargest(5, audio_formats, key=lambda x: x['abr'] or 0)
     
     # Create simple options for UI
     simple_options = []
@@ -528,28 +580,25 @@ async def get_available_formats(url: str) -> Dict[str, Any]:
         'size_mb': audio_size,
     })
     
-    # Video options - group by height
-    heights_added = set()
-    for vf in video_formats:
-        height = vf.get('height', 0)
-        if height and height not in heights_added and height >= 360:
-            heights_added.add(height)
-            
-            # Find best format with audio for this height
-            label = f"MP4 {height}p"
-            if height >= 1080:
-                label += " (HD)"
-            elif height >= 720:
-                label += " (HD)"
-            
-            simple_options.append({
-                'id': f'video_{height}',
-                'label': label,
-                'type': 'video',
-                'ext': 'mp4',
-                'height': height,
-                'size_mb': vf.get('filesize_mb'),
-            })
+    # Video options - one per height
+    for height in sorted(best_by_height, reverse=True):
+        vf = best_by_height[height]
+        
+        # Find best format with audio for this height
+        label = f"MP4 {height}p"
+        if height >= 1080:
+            label += " (HD)"
+        elif height >= 720:
+            label += " (HD)"
+        
+        simple_options.append({
+            'id': f'video_{height}',
+            'label': label,
+            'type': 'video',
+            'ext': 'mp4',
+            'height': height,
+            'size_mb': vf.get('filesize_mb'),
+        })
     
     return {
         'platform': platform,
@@ -558,7 +607,7 @@ async def get_available_formats(url: str) -> Dict[str, Any]:
         'duration_str': f"{int(duration // 60)}:{int(duration % 60):02d}" if duration else None,
         'thumbnail': info.get('thumbnail'),
         'options': simple_options,
-        'video_formats': video_formats[:10],  # Limit to top 10
-        'audio_formats': audio_formats[:5],
+        'video_formats': video_formats,  # Top 10
+        'audio_formats': audio_formats,  # Top 5
     }
 
@@ -5,20 +5,52 @@ Returns text with word-level timestamps and VTT format.
 Handles large files by splitting them into chunks using FFmpeg.
 """
 
+import asyncio
+import aiofiles
+import aiofiles.os
 import httpx
+import io
 import os
+import re
+import shutil
 import subprocess
 from pathlib import Path
-from typing import Optional, List
+from typing import Optional, List, AsyncIterator, Tuple
 
 from app.config import (
     CLOUDFLARE_ACCOUNT_ID, 
     CLOUDFLARE_API_TOKEN,
     WHISPER_MODEL,
+    SHORT_AUDIO_MODEL,
+    SHORT_AUDIO_MAX_DURATION,
 )
 from app.services.audio_downloader import _get_ffmpeg_location
 
 
+# Chunk length used when the file's bitrate cannot be probed
+CHUNK_SEGMENT_SECONDS = 300  # 5 minutes
+
+# Chunks are sized to this fraction of the limit (VBR files vary in bitrate)
+CHUNK_SIZE_MARGIN = 0.9
+
+# Max chunks sent to Cloudflare at the same time (whole process, shared by
+# all transcriptions so parallel requests don't multiply the rate)
+MAX_CONCURRENT_CHUNKS = 5
+_chunk_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHUNKS)
+
+# Block size when streaming a chunk file to Cloudflare
+CHUNK_READ_SIZE = 64 * 1024
+
+# Don't open a console window for ffmpeg/ffprobe on Windows
+_SUBPROCESS_FLAGS = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+
+# Last characters that end a sentence (subtitle segment / text line)
+_SENTENCE_ENDS = frozenset('.!?。？！…')
+
+# Sentence end followed by spaces (line-break fallback when there are no words)
+_SENTENCE_BREAK_PATTERN = re.compile(r'([.!?。？！]) +')
+
+
 class TranscriptionError(Exception):
     """Custom exception for transcription errors."""
     pass
@@ -26,132 +58,204 @@ class TranscriptionError(Exception):
 
 def format_vtt_time(seconds: float) -> str:
     """Convert seconds to VTT time format (HH:MM:SS.mmm)"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = seconds % 60
-    return f"{hours:02d}:{minutes:02d}:{secs:06.3f}"
+    # Work in whole milliseconds so rounding carries into the seconds
+    millis = round(seconds * 1000)
+    hours, millis = divmod(millis, 3_600_000)
+    minutes, millis = divmod(millis, 60_000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}.{millis:03d}"
 
 
-def generate_vtt(words: List[dict]) -> str:
+class TranscriptBuilder:
     """
-    Generate VTT subtitle format from word timestamps.
-    Groups words into subtitle segments (~5 seconds each).
+    Collects chunk results and renders the formatted text and VTT subtitles.
+    
+    Both renderings are built in a single pass over the words, as each chunk
+    is added, instead of two sweeps over the whole transcript at the end.
+    Without timestamps, words are only counted: no VTT, no word list, and the
+    text is broken into lines at sentence ends.
     """
-    if not words:
-        return ""
     
-    vtt_lines = ["WEBVTT", ""]
+    def __init__(self, language: Optional[str] = None, include_timestamps: bool = True):
+        self.language_hint = language
+        self.language = language or 'unknown'
+        self.include_timestamps = include_timestamps
+        self.words: List[dict] = []
+        self.word_count = 0
+        self.text_parts: List[str] = []
+        
+        # VTT: subtitle segments (~5 seconds each, or up to a sentence end)
+        self._vtt = io.StringIO()
+        self._vtt.write("WEBVTT\n")
+        self._segment_words: List[str] = []
+        self._segment_start = 0
+        
+        # Text: line breaks at sentence ends or long pauses
+        self._lines: List[str] = []
+        self._line_words: List[str] = []
+        self._last_end = 0
     
-    # Group words into segments
-    segment_words = []
-    segment_start = 0
+    def add_chunk(self, part: dict) -> None:
+        """Add one chunk as yielded by iter_transcription_chunks."""
+        if part['text']:
+            self.text_parts.append(part['text'])
+        
+        # Detect language from first chunk if not set
+        if part['index'] == 0 and not self.language_hint:
+            self.language = part['language']
+        
+        self.word_count += len(part['words'])
+        if not self.include_timestamps:
+            return
+        
+        self.words.extend(part['words'])
+        for word in part['words']:
+            word_text = word.get('word', '')
+            self._add_to_vtt(word, word_text)
+            self._add_to_text(word, word_text)
     
-    for word in words:
-        if not segment_words:
-            segment_start = word.get('start', 0)
+    def _add_to_vtt(self, word: dict, word_text: str) -> None:
+        if not self._segment_words:
+            self._segment_start = word.get('start', 0)
         
-        segment_words.append(word.get('word', ''))
-        segment_end = word.get('end', segment_start + 5)
+        self._segment_words.append(word_text)
+        segment_end = word.get('end', self._segment_start + 5)
         
         # Create new segment every ~5 seconds or at sentence end
-        word_text = word.get('word', '')
-        is_sentence_end = word_text.endswith(('.', '!', '?', '。', '？', '！'))
+        is_sentence_end = word_text[-1:] in _SENTENCE_ENDS
         
-        if segment_end - segment_start >= 5 or is_sentence_end:
-            text = ' '.join(segment_words).strip()
-            if text:
-                vtt_lines.append(f"{format_vtt_time(segment_start)} --> {format_vtt_time(segment_end)}")
-                vtt_lines.append(text)
-                vtt_lines.append("")
-            segment_words = []
+        if segment_end - self._segment_start >= 5 or is_sentence_end:
+            self._write_cue(segment_end)
     
-    # Handle remaining words
-    if segment_words:
-        text = ' '.join(segment_words).strip()
+    def _write_cue(self, end: float) -> None:
+        text = ' '.join(self._segment_words).strip()
         if text:
-            end_time = words[-1].get('end', segment_start + 5) if words else segment_start + 5
-            vtt_lines.append(f"{format_vtt_time(segment_start)} --> {format_vtt_time(end_time)}")
-            vtt_lines.append(text)
-            vtt_lines.append("")
+            self._vtt.write(f"\n{format_vtt_time(self._segment_start)} --> {format_vtt_time(end)}\n{text}\n")
+        self._segment_words = []
     
-    return '\n'.join(vtt_lines)
-
-
-def format_text_with_timestamps(words: List[dict], text: str) -> str:
-    """
-    Format text with line breaks for better readability.
-    Adds paragraph breaks at sentence endings.
-    """
-    if not text:
-        return ""
-    
-    # If we have word timestamps, use them to add line breaks
-    if words:
-        lines = []
-        current_line = []
-        last_end = 0
+    def _add_to_text(self, word: dict, word_text: str) -> None:
+        start = word.get('start', self._last_end)
         
-        for word in words:
-            word_text = word.get('word', '')
-            start = word.get('start', last_end)
-            
-            current_line.append(word_text)
-            
-            # Check for sentence end or long pause (>1.5 seconds)
-            is_sentence_end = word_text.rstrip().endswith(('.', '!', '?', '。', '？', '！', '…'))
-            pause = start - last_end if last_end > 0 else 0
-            
-            if is_sentence_end or pause > 1.5:
-                lines.append(' '.join(current_line).strip())
-                current_line = []
-            
-            last_end = word.get('end', start + 0.5)
+        self._line_words.append(word_text)
         
-        if current_line:
-            lines.append(' '.join(current_line).strip())
+        # Check for sentence end or long pause (>1.5 seconds)
+        is_sentence_end = word_text.rstrip()[-1:] in _SENTENCE_ENDS
+        pause = start - self._last_end if self._last_end > 0 else 0
         
-        return '\n'.join(filter(None, lines))
+        if is_sentence_end or pause > 1.5:
+            self._lines.append(' '.join(self._line_words).strip())
+            self._line_words = []
+        
+        self._last_end = word.get('end', start + 0.5)
     
-    # Fallback: just return original text with basic formatting
-    import re
-    # Add line breaks after sentences
-    formatted = re.sub(r'([.!?。？！]) +', r'\1\n', text)
-    return formatted
+    def build(self) -> dict:
+        """Assemble the final transcription result (call once, after the last chunk)."""
+        full_text_raw = " ".join(self.text_parts)
+        
+        # Handle remaining words
+        if self._segment_words:
+            self._write_cue(self.words[-1].get('end', self._segment_start + 5))
+        if self._line_words:
+            self._lines.append(' '.join(self._line_words).strip())
+            self._line_words = []
+        
+        if not full_text_raw:
+            formatted_text = ""
+        elif self.words:
+            formatted_text = '\n'.join(filter(None, self._lines))
+        else:
+            # Fallback without timestamps: add line breaks after sentences
+            formatted_text = _SENTENCE_BREAK_PATTERN.sub(r'\1\n', full_text_raw)
+        
+        return {
+            'text': formatted_text,
+            'text_raw': full_text_raw,
+            # Whisper already segmented the words; only split the text without them
+            'word_count': self.word_count or len(full_text_raw.split()),
+            'language': self.language,
+            'words': self.words,
+            'vtt': self._vtt.getvalue() if self.words else "",
+        }
+
+
+def _ffmpeg_tool(name: str) -> str:
+    """Full path of an FFmpeg binary (ffmpeg/ffprobe), or just its name for PATH lookup."""
+    location = _get_ffmpeg_location()
+    if location:
+        return shutil.which(name, path=location) or name
+    return name
 
 
-def split_audio_into_chunks(audio_path: Path, chunk_size_mb: int = 9) -> List[Path]:
+def _probe_bit_rate(audio_path: Path) -> Optional[float]:
+    """Read the overall bitrate (bits/s) of an audio file with ffprobe."""
+    cmd = [
+        _ffmpeg_tool('ffprobe'), '-v', 'error',
+        '-show_entries', 'format=bit_rate',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        str(audio_path),
+    ]
+    try:
+        output = subprocess.run(
+            cmd, check=True, capture_output=True, text=True,
+            stdin=subprocess.DEVNULL, creationflags=_SUBPROCESS_FLAGS,
+        ).stdout
+        bit_rate = float(output.strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+    return bit_rate if bit_rate > 0 else None
+
+
+def split_audio_into_chunks(
+    audio_path: Path, 
+    chunk_size_mb: int = 9,
+    duration: Optional[float] = None
+) -> Tuple[List[Path], float]:
     """
     Split audio file into smaller chunks using FFmpeg if it exceeds the size limit.
     Target size slightly less than 10MB to be safe.
+    
+    Chunks are made as long as the size limit allows, based on the file's bitrate.
+    When the duration is already known (e.g. from yt-dlp metadata) the bitrate is
+    derived from it, otherwise it is probed with ffprobe.
+    
+    Returns:
+        Tuple of (chunk paths, length of each chunk in seconds)
     """
+    segment_time = CHUNK_SEGMENT_SECONDS
     try:
         file_size = audio_path.stat().st_size
         
         # If file is small enough, return as single chunk
         if file_size <= chunk_size_mb * 1024 * 1024:
-            return [audio_path]
+            return [audio_path], segment_time
         
         print(f"[DEBUG] File size {file_size/1024/1024:.2f}MB exceeds limit. Splitting...")
         
-        # Calculate duration to estimate splitting
-        ffmpeg_cmd = _get_ffmpeg_location() or 'ffmpeg'
-        if ffmpeg_cmd != 'ffmpeg':
-            ffmpeg_cmd = str(Path(ffmpeg_cmd) / 'ffmpeg.exe')
-
-        # Split strategy
-        segment_time = 300  # 5 minutes
+        # Split strategy: longest segment that stays under the size limit
+        if duration:
+            bit_rate = file_size * 8 / duration
+        else:
+            bit_rate = _probe_bit_rate(audio_path)
+        if bit_rate:
+            # At least 1s: very high bitrates (or a bogus duration) would truncate to 0
+            segment_time = max(1, int(chunk_size_mb * 1024 * 1024 * 8 * CHUNK_SIZE_MARGIN / bit_rate))
         
         output_pattern = str(audio_path.parent / f"{audio_path.stem}_chunk_%03d{audio_path.suffix}")
         
         cmd = [
-            ffmpeg_cmd, '-i', str(audio_path),
+            _ffmpeg_tool('ffmpeg'), '-hide_banner', '-loglevel', 'error', '-nostats',
+            '-i', str(audio_path),
             '-f', 'segment',
             '-segment_time', str(segment_time),
             '-c', 'copy',
             output_pattern
         ]
         
-        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(
+            cmd, check=True,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            creationflags=_SUBPROCESS_FLAGS,
+        )
             
         # Find generated chunks
         chunks = []
@@ -160,152 +264,225 @@ def split_audio_into_chunks(audio_path: Path, chunk_size_mb: int = 9) -> List[Pa
             
         if not chunks:
             # Maybe failed to generate pattern?
-            return [audio_path]
+            return [audio_path], segment_time
             
-        print(f"[DEBUG] Split into {len(chunks)} chunks.")
-        return chunks
+        print(f"[DEBUG] Split into {len(chunks)} chunks of {segment_time}s.")
+        return chunks, segment_time
         
     except Exception as e:
         print(f"[ERROR] Error splitting audio: {e}")
         # Fallback to single file if split fails
-        return [audio_path]
+        return [audio_path], segment_time
+
+
+def create_client(**kwargs) -> httpx.AsyncClient:
+    """
+    Create the HTTP client used for Cloudflare Workers AI calls.
+    The account base URL and auth header are set once on the client, and its
+    HTTP/2 connections are kept alive and reused across chunks and requests.
+    
+    Args:
+        **kwargs: Overrides for httpx.AsyncClient options (e.g. limits, transport)
+    
+    Returns:
+        Configured httpx.AsyncClient (close it with aclose())
+    """
+    options = {
+        'base_url': f"https://api.cloudflare.com/client/v4/accounts/{CLOUDFLARE_ACCOUNT_ID}/ai",
+        'headers': {"Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}"},
+        'http2': True,
+        'timeout': 300.0,
+        'limits': httpx.Limits(max_keepalive_connections=MAX_CONCURRENT_CHUNKS),
+    }
+    options.update(kwargs)
+    return httpx.AsyncClient(**options)
+
+
+async def warm_up_connection(client: httpx.AsyncClient) -> None:
+    """
+    Connect to Cloudflare ahead of the first transcription.
+    DNS, TCP and TLS are done once and the connection stays in the client's pool.
+    Failures are ignored: the first real request will simply connect itself.
+    """
+    try:
+        await client.head("https://api.cloudflare.com/client/v4/", timeout=10.0)
+    except httpx.HTTPError:
+        pass
+
+
+async def _iter_file(path: Path) -> AsyncIterator[bytes]:
+    """Read a file in blocks without blocking the event loop."""
+    async with aiofiles.open(path, 'rb') as f:
+        while block := await f.read(CHUNK_READ_SIZE):
+            yield block
 
 
 async def process_single_chunk(
     chunk_path: Path, 
-    language: Optional[str]
+    language: Optional[str],
+    client: httpx.AsyncClient,
+    model: str = WHISPER_MODEL
 ) -> dict:
-    """Helper to process a single audio chunk."""
+    """
+    Helper to process a single audio chunk.
+    Uses the given client (from create_client) so chunks share its pooled connections.
+    """
     try:
-        with open(chunk_path, 'rb') as f:
-            audio_data = f.read()
+        chunk_size = (await aiofiles.os.stat(chunk_path)).st_size
     except Exception as e:
         raise TranscriptionError(f"Failed to read audio chunk: {str(e)}")
     
-    audio_array = list(audio_data)
-    
-    url = f"https://api.cloudflare.com/client/v4/accounts/{CLOUDFLARE_ACCOUNT_ID}/ai/run/{WHISPER_MODEL}"
+    # Whisper accepts the raw audio file as the request body
     headers = {
-        "Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}",
-        "Content-Type": "application/json",
+        "Content-Type": "application/octet-stream",
+        # Known length: the body is streamed from disk, not chunk-encoded
+        "Content-Length": str(chunk_size),
     }
     
     try:
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.post(
-                url,
-                headers=headers,
-                json={"audio": audio_array},
-            )
+        response = await client.post(
+            f"/run/{model}", headers=headers, content=_iter_file(chunk_path)
+        )
+        
+        result = response.json()
+        
+        if response.status_code != 200:
+            print(f"[ERROR] API Error for chunk {chunk_path.name}: {response.status_code}")
+            # Don't raise error, just return empty so other chunks can proceed
+            return {'text': '', 'words': []}
             
-            result = response.json()
+        if not result.get('success'):
+            print(f"[ERROR] API Success=False for chunk {chunk_path.name}")
+            return {'text': '', 'words': []}
             
-            if response.status_code != 200:
-                print(f"[ERROR] API Error for chunk {chunk_path.name}: {response.status_code}")
-                # Don't raise error, just return empty so other chunks can proceed
-                return {'text': '', 'words': []}
-                
-            if not result.get('success'):
-                print(f"[ERROR] API Success=False for chunk {chunk_path.name}")
-                return {'text': '', 'words': []}
-                
-            return result.get('result', {})
+        return result.get('result', {})
             
     except Exception as e:
         print(f"[ERROR] Exception processing chunk {chunk_path.name}: {e}")
         return {'text': '', 'words': []}
 
 
-async def transcribe_audio(
+async def iter_transcription_chunks(
     audio_path: Path,
     language: Optional[str] = None,
-    include_timestamps: bool = True
-) -> dict:
+    client: Optional[httpx.AsyncClient] = None,
+    duration: Optional[float] = None
+) -> AsyncIterator[dict]:
     """
-    Transcribe an audio file using Cloudflare Workers AI (Whisper).
-    Handles large files by splitting them into chunks.
+    Transcribe an audio file chunk by chunk, yielding each chunk as soon as it is done.
+    Word timestamps are already shifted to their position in the full file.
     
     Args:
         audio_path: Path to the audio file
         language: Optional language hint
-        include_timestamps: Whether to include timestamps
+        client: Optional shared client from create_client (keeps connections to
+            Cloudflare alive). When omitted, one is opened for all chunks of this file.
+        duration: Optional known duration in seconds (saves probing the file)
     
-    Returns:
-        Dictionary with transcription results
+    Yields:
+        Dict with index, total, text, words and language of the chunk
     """
     if not audio_path.exists():
         raise TranscriptionError(f"Audio file not found: {audio_path}")
     
-    # Split audio if needed
-    chunks = split_audio_into_chunks(audio_path)
+    # Split audio if needed (ffmpeg runs in a worker thread so other
+    # requests' downloads/uploads keep progressing meanwhile)
+    chunks, segment_time = await asyncio.to_thread(
+        split_audio_into_chunks, audio_path, duration=duration
+    )
     
-    all_words = []
-    full_text_parts = []
-    time_offset = 0.0
-    detected_language = language or 'unknown'
+    # Short clips can use a smaller, faster model if one is configured
+    model = WHISPER_MODEL
+    if SHORT_AUDIO_MODEL and duration and duration <= SHORT_AUDIO_MAX_DURATION:
+        model = SHORT_AUDIO_MODEL
     
-    # Process chunks sequence
-    for i, chunk in enumerate(chunks):
-        print(f"Transferring chunk {i+1}/{len(chunks)}...")
-        
-        # Process chunk
-        result = await process_single_chunk(chunk, language)
-        
-        chunk_text = result.get('text', '')
-        chunk_words = result.get('words', [])
-        
-        if chunk_text:
-            full_text_parts.append(chunk_text)
-        
-        # Adjust timestamps
-        if chunk_words:
+    # Without a shared client, still reuse one connection for every chunk
+    # rather than paying a TLS handshake per request
+    own_client = None
+    if client is None:
+        client = own_client = create_client()
+    
+    # All chunks are sent concurrently (bounded by the process-wide
+    # semaphore); results are still yielded in order as each one becomes available
+    async def transcribe_chunk(i: int, chunk: Path) -> dict:
+        async with _chunk_semaphore:
+            print(f"Transferring chunk {i+1}/{len(chunks)}...")
+            return await process_single_chunk(chunk, language, client, model)
+    
+    tasks = [
+        asyncio.create_task(transcribe_chunk(i, chunk))
+        for i, chunk in enumerate(chunks)
+    ]
+    
+    try:
+        for i, task in enumerate(tasks):
+            result = await task
+            
+            chunk_text = result.get('text', '')
+            chunk_words = result.get('words', [])
+            
+            # Chunk i starts exactly i segments into the file
+            time_offset = i * segment_time
+            
+            # Adjust timestamps (missing ones continue from the previous word)
             last_word_end = time_offset
             for word in chunk_words:
                 start = word.get('start')
+                start = start + time_offset if isinstance(start, (int, float)) else last_word_end
                 end = word.get('end')
-                
-                # Check if start/end are valid numbers
-                if start is not None and isinstance(start, (int, float)):
-                    word['start'] = start + time_offset
-                else:
-                    word['start'] = last_word_end
-                
-                if end is not None and isinstance(end, (int, float)):
-                    word['end'] = end + time_offset
-                    last_word_end = word['end']
-                else:
-                    word['end'] = word['start'] + 0.1 # Fallback
-                    last_word_end = word['end']
-                
-                all_words.append(word)
+                end = end + time_offset if isinstance(end, (int, float)) else start + 0.1
+                word['start'] = start
+                word['end'] = last_word_end = end
             
-            # Update offset for next chunk
-            time_offset = last_word_end
-        else:
-            # If no words detected in this chunk, add approximate duration
-            # Default segment time is 300s (5m)
-            time_offset += 300.0
-        
-        # Detect language from first chunk if not set
-        if i == 0 and not language:
-            detected_language = result.get('language', 'unknown')
-
-        # Clean up chunk if it's not the original file
-        if chunk != audio_path:
-            try:
-                os.remove(chunk)
-            except:
-                pass
-
-    full_text_raw = " ".join(full_text_parts)
-    formatted_text = format_text_with_timestamps(all_words, full_text_raw)
-    vtt = generate_vtt(all_words)
+            yield {
+                'index': i,
+                'total': len(chunks),
+                'text': chunk_text,
+                'words': chunk_words,
+                'language': result.get('language', 'unknown'),
+            }
+    finally:
+        # Stop outstanding requests if the consumer stops early (e.g. a
+        # streaming client disconnects), then clean up chunk files
+        for task in tasks:
+            task.cancel()
+        if own_client is not None:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await own_client.aclose()
+        for chunk in chunks:
+            if chunk != audio_path:
+                try:
+                    os.remove(chunk)
+                except OSError:
+                    pass
+
+
+async def transcribe_audio(
+    audio_path: Path,
+    language: Optional[str] = None,
+    include_timestamps: bool = True,
+    client: Optional[httpx.AsyncClient] = None,
+    duration: Optional[float] = None
+) -> dict:
+    """
+    Transcribe an audio file using Cloudflare Workers AI (Whisper).
+    Handles large files by splitting them into chunks.
     
-    return {
-        'text': formatted_text,
-        'text_raw': full_text_raw,
-        'word_count': len(full_text_raw.split()),
-        'language': detected_language,
-        'words': all_words,
-        'vtt': vtt,
-    }
+    Args:
+        audio_path: Path to the audio file
+        language: Optional language hint
+        include_timestamps: Whether to include word timestamps and VTT
+            (False skips rendering them; the text is still formatted)
+        client: Optional shared client from create_client (keeps connections to Cloudflare alive)
+        duration: Optional known duration in seconds (saves probing the file)
+    
+    Returns:
+        Dictionary with transcription results
+    """
+    transcript = TranscriptBuilder(language, include_timestamps)
+    
+    # Each chunk is rendered while the following ones are still being transcribed
+    async for part in iter_transcription_chunks(audio_path, language, client, duration):
+        transcript.add_chunk(part)
+    
+    return transcript.build()
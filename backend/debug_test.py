@@ -2,62 +2,84 @@
 Debug script to test transcription with a simple English video.
 """
 import asyncio
+import atexit
 import os
 import sys
+import uuid
+from collections import deque
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app.services.audio_downloader import download_audio, _get_ffmpeg_location
-from app.services.transcription import transcribe_audio
-from app.config import CLOUDFLARE_ACCOUNT_ID, CLOUDFLARE_API_TOKEN
+from app.services.transcription import (
+    iter_transcription_chunks,
+    TranscriptBuilder,
+    create_client,
+    warm_up_connection,
+)
+from app.config import CLOUDFLARE_ACCOUNT_ID, CLOUDFLARE_API_TOKEN, TEMP_DIR
 
-log_file = open("debug_output.txt", "w", encoding="utf-8")
+# Collected in memory and written once at exit (also after an unhandled
+# error), so logging never does file I/O on the event loop. Only the most
+# recent lines are kept so a long run cannot grow the buffer without bound.
+log_lines = deque(maxlen=10000)
+
+def write_log():
+    with open("debug_output.txt", "w", encoding="utf-8") as log_file:
+        log_file.write("\n".join(log_lines) + "\n")
+
+atexit.register(write_log)
+
+# Downloaded files are removed after transcription; whatever is left
+# (failed or cancelled run) is removed at exit. Names are recorded before
+# the download starts: a cancelled download keeps running in its yt-dlp
+# thread, and interpreter exit waits for that thread before atexit hooks run.
+download_names = []
+
+def remove_downloads():
+    for name in download_names:
+        # Final MP3 plus any intermediate files yt-dlp left behind
+        for path in TEMP_DIR.glob(f"{name}.*"):
+            path.unlink(missing_ok=True)
+
+atexit.register(remove_downloads)
 
 def log(msg):
     print(msg)
-    log_file.write(msg + "\n")
-    log_file.flush()
+    log_lines.append(msg)
 
-async def main():
-    log("=" * 60)
-    log("DEBUG: Transcript API Test (Simple English Video)")
-    log("=" * 60)
-    
-    # Check FFmpeg
-    log("\n1. Checking FFmpeg...")
-    ffmpeg_loc = _get_ffmpeg_location()
-    log(f"   FFmpeg: {ffmpeg_loc}")
-    if not ffmpeg_loc:
-        log("   [X] FFmpeg not found!")
-        return
-    
-    # Check Cloudflare
-    log("\n2. Checking Cloudflare...")
-    log(f"   Account ID: {CLOUDFLARE_ACCOUNT_ID[:10]}..." if CLOUDFLARE_ACCOUNT_ID else "   NOT SET")
-    log(f"   API Token: {CLOUDFLARE_API_TOKEN[:10]}..." if CLOUDFLARE_API_TOKEN else "   NOT SET")
-    
-    # Test with a SHORT English-only video (TED-Ed intro, ~1 min)
-    test_urls = [
-        # Short English video - motivational quote
-        "https://www.youtube.com/watch?v=ZXsQAXx_ao0",  # Very short tech video
-    ]
-    
-    for test_url in test_urls:
-        log(f"\n3. Testing download: {test_url}")
+async def download_worker(urls, queue):
+    """Download each URL and hand the audio to the transcription worker."""
+    for test_url in urls:
+        log(f"\n[download] Testing download: {test_url}")
+        name = str(uuid.uuid4())
+        download_names.append(name)
         try:
-            audio_path, metadata = await download_audio(test_url)
+            audio_path, metadata = await download_audio(test_url, output_filename=name)
             log(f"   [OK] Downloaded: {audio_path.name}")
             log(f"   Platform: {metadata.get('platform')}")
-            log(f"   Title: {metadata.get('title', 'N/A')[:50]}")
+            log(f"   Title: {(metadata.get('title') or 'N/A')[:50]}")
             file_size = os.path.getsize(audio_path)
             log(f"   File size: {file_size / 1024:.1f} KB")
         except Exception as e:
             log(f"   [X] Download failed: {e}")
             continue
-        
-        log("\n4. Testing transcription...")
+        # Waits while the transcriber is busy and the queue is full
+        await queue.put(audio_path)
+    await queue.put(None)  # No more files
+
+async def transcribe_worker(queue, client):
+    """Transcribe downloaded files while the next ones are downloading."""
+    while (audio_path := await queue.get()) is not None:
+        log(f"\n[transcribe] Testing transcription: {audio_path.name}")
         try:
-            result = await transcribe_audio(audio_path)
+            # Same path as /transcribe/stream: report each chunk as soon as it is done
+            # Only text and word count are shown: skip words/VTT rendering
+            transcript = TranscriptBuilder(include_timestamps=False)
+            async for part in iter_transcription_chunks(audio_path, client=client):
+                transcript.add_chunk(part)
+                log(f"   Chunk {part['index'] + 1}/{part['total']}: {part['text'][:80]}")
+            result = transcript.build()
             log(f"   [OK] Transcription successful!")
             log(f"   Word count: {result['word_count']}")
             log(f"   Text preview: {result['text'][:300]}...")
@@ -65,14 +87,58 @@ async def main():
             log(f"   [X] Transcription failed: {e}")
         
         # Cleanup
-        if audio_path.exists():
-            os.remove(audio_path)
-            log("   [OK] Cleaned up")
-        break  # Only test first video
+        audio_path.unlink(missing_ok=True)
+        log("   [OK] Cleaned up")
+
+async def main():
+    log("=" * 60)
+    log("DEBUG: Transcript API Test (Simple English Video)")
+    log("=" * 60)
+    
+    # Test with a SHORT English-only video (TED-Ed intro, ~1 min)
+    test_urls = [
+        # Short English video - motivational quote
+        "https://www.youtube.com/watch?v=ZXsQAXx_ao0",  # Very short tech video
+    ]
+    
+    # Downloads (network) overlap with transcription of the previous file
+    queue = asyncio.Queue(maxsize=2)
+    # One Cloudflare connection pool for every file, as the API server does
+    async with create_client() as client:
+        # Start downloading right away; the environment checks run meanwhile
+        downloader = asyncio.create_task(download_worker(test_urls[:1], queue))  # Only test first video
+        warmup = asyncio.create_task(warm_up_connection(client))
+        
+        # Check FFmpeg
+        log("\n[env] Checking FFmpeg...")
+        ffmpeg_loc = await asyncio.to_thread(_get_ffmpeg_location)
+        log(f"   FFmpeg: {ffmpeg_loc}")
+        if not ffmpeg_loc:
+            log("   [X] FFmpeg not found!")
+            # Only stops waiting: the yt-dlp thread can't be interrupted, so the
+            # download still runs to completion in the background and exit
+            # waits for it (remove_downloads then deletes the file)
+            downloader.cancel()
+            warmup.cancel()
+            return
+        
+        # Check Cloudflare
+        log("\n[env] Checking Cloudflare...")
+        log(f"   Account ID: {CLOUDFLARE_ACCOUNT_ID[:10]}..." if CLOUDFLARE_ACCOUNT_ID else "   Account ID: NOT SET")
+        log(f"   API Token: {CLOUDFLARE_API_TOKEN[:10]}..." if CLOUDFLARE_API_TOKEN else "   API Token: NOT SET")
+        
+        await asyncio.gather(downloader, warmup, transcribe_worker(queue, client))
     
     log("\n" + "=" * 60)
     log("Test completed!")
-    log_file.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop  # Comes with uvicorn[standard] (not available on Windows)
+    except ImportError:
+        uvloop = None
+    # uvloop.run() only exists in uvloop >= 0.18
+    if hasattr(uvloop, "run"):
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
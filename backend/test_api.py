@@ -3,46 +3,81 @@ Simple test script for the Transcript API.
 Run with: python test_api.py
 """
 
+import os
 import httpx
 import asyncio
 
 BASE_URL = "http://127.0.0.1:8888"
+# BENCH=1: only check status codes (no JSON parsing / printing)
+BENCH = os.getenv("BENCH") == "1"
+# Optional: short video URL to also test /transcribe
+# (e.g. TEST_URL=https://www.youtube.com/watch?v=SHORT_VIDEO_ID)
+TEST_URL = os.getenv("TEST_URL")
+
+# One client for every test (and for scripts importing these tests):
+# keep-alive connections are reused instead of reconnecting per call
+CLIENT = httpx.AsyncClient(
+    base_url=BASE_URL,
+    timeout=300.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
 
 async def test_health():
     """Test health endpoint"""
+    if BENCH:
+        response = await CLIENT.head("/health")
+        return response.status_code == 204
+    
     print("Testing /health endpoint...")
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{BASE_URL}/health")
-        print(f"Status: {response.status_code}")
-        print(f"Response: {response.json()}")
-        return response.status_code == 200
+    response = await CLIENT.get("/health")
+    print(f"Status: {response.status_code}")
+    print(f"Response: {response.json()}")
+    return response.status_code == 200
 
 async def test_transcribe(url: str):
     """Test transcribe endpoint"""
     print(f"\nTesting /transcribe with URL: {url}")
-    async with httpx.AsyncClient(timeout=300.0) as client:
-        response = await client.post(
-            f"{BASE_URL}/transcribe",
-            json={"url": url}
-        )
-        print(f"Status: {response.status_code}")
-        print(f"Response: {response.json()}")
-        return response.status_code == 200
+    response = await CLIENT.post("/transcribe", json={"url": url})
+    print(f"Status: {response.status_code}")
+    print(f"Response: {response.json()}")
+    return response.status_code == 200
+
+def report(name: str, result):
+    """Print one test's outcome (gather returns exceptions instead of raising)"""
+    if isinstance(result, BaseException):
+        print(f"✗ {name} failed: {result!r}")
+    else:
+        print(f"✓ {name} passed: {result}")
 
 async def main():
     print("=" * 50)
     print("Transcript API Test")
     print("=" * 50)
     
-    # Test health
-    health_ok = await test_health()
-    print(f"\n✓ Health check passed: {health_ok}")
-    
-    # Optional: Test transcription (uncomment and add a short video URL)
-    # await test_transcribe("https://www.youtube.com/watch?v=SHORT_VIDEO_ID")
+    try:
+        # Independent tests run concurrently on the shared client
+        tests = [test_health()]
+        if TEST_URL:
+            tests.append(test_transcribe(TEST_URL))
+        results = await asyncio.gather(*tests, return_exceptions=True)
+        
+        print()
+        report("Health check", results[0])
+        if TEST_URL:
+            report("Transcription", results[1])
+    finally:
+        await CLIENT.aclose()
     
     print("\n" + "=" * 50)
     print("All tests completed!")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop  # Comes with uvicorn[standard] (not available on Windows)
+    except ImportError:
+        uvloop = None
+    # uvloop.run() only exists in uvloop >= 0.18
+    if hasattr(uvloop, "run"):
+        uvloop.run(main())
+    else:
+        asyncio.run(main())